@@ -11,16 +11,20 @@
 
 from __future__ import annotations
 
+import warnings
+from contextlib import AbstractContextManager, nullcontext
 from typing import TYPE_CHECKING, Any, Callable, Iterable, Sequence
 
 import torch
 from monai.config import IgniteInfo
+from monai.data import MetaTensor
 from monai.engines.trainer import Trainer
 from monai.engines.utils import CommonKeys as Keys
 from monai.engines.utils import default_metric_cmp_fn, default_prepare_batch
 from monai.inferers import Inferer, SimpleInferer
 from monai.transforms import Transform
-from monai.utils import min_version, optional_import
+from monai.utils import min_version, optional_import, pytorch_after
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim.optimizer import Optimizer
 from torch.utils.data import DataLoader
 
@@ -37,6 +41,66 @@ else:
 __all__ = ["AdversarialTrainer"]
 
 
+def _grad_scaler() -> torch.amp.GradScaler:
+    """Create a CUDA `GradScaler`, using the deprecated `torch.cuda.amp` API only for older PyTorch versions."""
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda")
+    return torch.cuda.amp.GradScaler()
+
+
+def _contiguous(data: torch.Tensor, channels_last: bool) -> torch.Tensor:
+    """
+    Return `data` contiguous in memory, using the `torch.channels_last` memory format if `channels_last` is True and
+    `data` is 4D. Network outputs are usually already in the right memory format, and are then returned as they are.
+    """
+    memory_format = torch.channels_last if channels_last and data.dim() == 4 else torch.contiguous_format
+    if data.is_contiguous(memory_format=memory_format):
+        return data
+    return data.contiguous(memory_format=memory_format)
+
+
+def _mean(loss: torch.Tensor) -> torch.Tensor:
+    """Average `loss` if it is not already reduced to a scalar, so that no reduction is launched for nothing."""
+    return loss if loss.ndim == 0 else loss.mean()
+
+
+def _no_sync(network: torch.nn.Module) -> AbstractContextManager:
+    """
+    Context in which the backward does not all-reduce the gradients of `network` if it is (a compiled)
+    `DistributedDataParallel`, no-op otherwise.
+    """
+    network = getattr(network, "_orig_mod", network)
+    return network.no_sync() if isinstance(network, DistributedDataParallel) else nullcontext()
+
+
+def _optimizer_params(optimizer: Optimizer) -> list[torch.Tensor]:
+    """Return the parameters updated by `optimizer`, those which require a gradient."""
+    return [p for group in optimizer.param_groups for p in group["params"] if p.requires_grad]
+
+
+def _detach(data: Any) -> Any:
+    """Detach the tensors of the output of a network, which can be a tensor or a (nested) sequence of tensors."""
+    if isinstance(data, torch.Tensor):
+        return data.detach()
+    if isinstance(data, (list, tuple)):
+        return type(data)(_detach(d) for d in data)
+    return data
+
+
+def _split_batch(data: Any, split_size: int) -> tuple[Any, Any]:
+    """
+    Split the output of a network along the batch dimension in two parts, the first one of size `split_size`.
+    The output can be a tensor or a (nested) sequence of tensors, such as the one of `PatchDiscriminator`.
+    """
+    if isinstance(data, torch.Tensor):
+        first, second = data.split([split_size, data.shape[0] - split_size], dim=0)
+        return first, second
+    if isinstance(data, (list, tuple)):
+        splits = [_split_batch(d, split_size) for d in data]
+        return type(data)(s[0] for s in splits), type(data)(s[1] for s in splits)
+    raise TypeError(f"The discriminator output must be a tensor or a sequence of tensors, got {type(data)}.")
+
+
 class AdversarialTrainer(Trainer):
     """
     Standard supervised training workflow for adversarial loss enabled neural networks.
@@ -46,15 +110,21 @@ class AdversarialTrainer(Trainer):
         max_epochs: the total epoch number for engine to run.
         train_data_loader: Core ignite engines uses `DataLoader` for training loop batchdata.
         g_network: ''generator'' (G) network architecture.
-        g_optimizer: G optimizer function.
+        g_optimizer: G optimizer function. The optimizer is used as given, so on GPU prefer creating it with
+            `fused=True` when supported (e.g. `torch.optim.Adam(..., fused=True)`) to update all the parameters in a
+            few multi-tensor kernels. Fused optimizers are also supported by the `GradScaler` used with `amp`.
         g_loss_function: G loss function for adversarial training.
         recon_loss_function: G loss function for reconstructions.
         d_network: discriminator (D) network architecture.
-        d_optimizer: D optimizer function.
-        d_loss_function: D loss function for adversarial training..
+        d_optimizer: D optimizer function. As for `g_optimizer`, prefer `fused=True` on GPU when supported.
+        d_loss_function: D loss function for adversarial training. The outputs of the loss functions are averaged
+            when they are not already scalars.
         epoch_length: number of iterations for one epoch, default to `len(train_data_loader)`.
         non_blocking: if True and this copy is between CPU and GPU, the copy may occur asynchronously with respect to
-            the host. For other cases, this argument has no effect.
+            the host. For other cases, this argument has no effect. The copy is only asynchronous from pinned host
+            memory, so use it with `DataLoader(..., pin_memory=True)`, and preferably `persistent_workers=True` so that
+            the workers are not restarted at every epoch. Custom batch types must implement a `pin_memory()` method
+            to be pinned by the `DataLoader`.
         prepare_batch: function to parse image and label for current iteration.
         iteration_update: the callable function for every iteration, expect to accept `engine` and `batchdata` as input
             parameters. if not provided, use `self._iteration()` instead.
@@ -80,10 +150,78 @@ class AdversarialTrainer(Trainer):
             `decollate=True` when `postprocessing` uses components from `monai.transforms`. default to `True`.
         optim_set_to_none: when calling `optimizer.zero_grad()`, instead of setting to zero, set the grads to None.
             more details: https://pytorch.org/docs/stable/generated/torch.optim.Optimizer.zero_grad.html.
+            default to `True`, which avoids writing zeros in every gradient tensor.
         to_kwargs: dict of other args for `prepare_batch` API when converting the input data, except for
             `device`, `non_blocking`.
-        amp_kwargs: dict of the args for `torch.cuda.amp.autocast()` API, for more details:
-            https://pytorch.org/docs/stable/amp.html#torch.cuda.amp.autocast.
+        amp_kwargs: dict of the args for `torch.autocast("cuda")` API, for more details:
+            https://pytorch.org/docs/stable/amp.html#torch.autocast.
+        reuse_fake_logits: whether the discriminator step reuses the D logits of the fake images computed during the
+            generator step instead of running D on the fakes a second time. The D weights are not updated in between,
+            so the logits are the same, but the generator backward has to retain its graph. The saved activations of
+            G are then kept during the discriminator step, which increases its peak memory by about the activation
+            memory of G. To release them, the outputs in `engine.state.output` are detached at the end of the
+            iteration, as with `keep_intermediate_outputs=False`. Set to `False` if some handler modifies D between
+            the generator and the discriminator steps. default to `True`.
+        d_concat_inputs: whether to concatenate the real and the fake images along the batch dimension and run a single
+            D forward on them, the logits being split afterwards. Only used when `reuse_fake_logits` is `False`.
+            D then normalises reals and fakes together, so prefer a D without BatchNorm (e.g. GroupNorm or
+            InstanceNorm) when enabling it. The `args` and `kwargs` returned by `prepare_batch` are given to
+            `d_inferer` as they are, so they must not depend on the batch size (e.g. no per-sample conditioning of D).
+            default to `False`.
+        d_forward_fp32: whether to cast the fake images to float32 before the D forward of the generator step when
+            `amp` is `False`. With `amp`, autocast already runs the ops of D in the right precision and no cast is
+            done. default to `False`.
+        compile: whether to use `torch.compile` on G and D, default is False. The compiled networks are only used for
+            the forward passes, `engine.state.g_network` and `engine.state.d_network` remain the original modules so
+            that the checkpoints are not affected. If True, MetaTensor inputs will be converted to `torch.Tensor`
+            before the forward passes, then converted back afterward with copied meta information. Custom inferers
+            that call the network in a way that cannot be traced (e.g. with data dependent control flow in Python)
+            may cause graph breaks or recompilations.
+        compile_kwargs: dict of the args for `torch.compile()` API, for more details:
+            https://pytorch.org/docs/stable/generated/torch.compile.html#torch-compile.
+        ddp: whether to wrap G and D in `DistributedDataParallel` for the forward passes, default is False. It
+            requires `torch.distributed` to be initialized, with one process per GPU, e.g. when launched with
+            `torchrun --nproc_per_node=N train.py`. Networks that are already `DistributedDataParallel` are used as
+            given. `engine.state.g_network` and `engine.state.d_network` remain the given modules, so the checkpoints
+            are not affected. The data loader should use a `DistributedSampler` and D should use SyncBatchNorm
+            instead of BatchNorm.
+        channels_last: whether to use the `torch.channels_last` memory format for G, D and the 4D (2D images) inputs
+            and targets, default is False. It is faster for 2D convolutions in float16/bfloat16 on recent GPUs. Inputs
+            of other dimensions, such as 3D volumes, are left unchanged.
+        cuda_graphs: whether to capture the forward and backward passes of G and D in CUDA graphs and replay them at
+            every iteration, which removes most of the kernel launch overhead, default is False. It enables `compile`
+            with the "reduce-overhead" mode of `torch.compile`, unless another mode is given in `compile_kwargs`.
+            The batches must have a fixed shape (e.g. `drop_last=True` in the data loader), otherwise new graphs are
+            captured for each new shape. Only the network passes are captured, so the handlers, the losses and the
+            optimizer steps, with or without `GradScaler`, are run as usual.
+        keep_intermediate_outputs: whether to write the outputs in `engine.state.output` as soon as they are computed,
+            so that they can be used by the handlers of the `AdversarialIterationEvents`, default is True. If False,
+            `engine.state.output` is only set at the end of the iteration, with detached tensors, so that the graphs
+            of G and D are released as soon as possible.
+        overlap_d_reals_forward: whether to run the D forward on the real images on a separate CUDA stream during the
+            generator backward and optimizer step, instead of after them, default is False. The D forward on the
+            reals does not depend on G, so both can run concurrently on the GPU. Only used on CUDA devices, and
+            not with `ddp`, `d_concat_inputs` or `cuda_graphs`. As for `reuse_fake_logits`, D must not be modified by
+            a handler between the generator and the discriminator steps.
+        allow_tf32: whether to allow TensorFloat-32 in the float32 matrix multiplications and cuDNN convolutions,
+            default is False. On Ampere and newer GPUs, it makes the training without `amp` much faster, at the cost
+            of a precision reduced to the 10 bits mantissa of TF32. The `torch.backends` flags are global, so this
+            also affects the rest of the process.
+        cudnn_benchmark: whether to set `torch.backends.cudnn.benchmark`, so that cuDNN selects the fastest
+            convolution algorithms for the input shapes, default is False. Only useful with fixed input shapes, as
+            the algorithms are benchmarked again for every new shape. The flag is global too.
+        accumulation_steps: number of iterations over which the gradients of G and D are accumulated before each
+            optimizer step, to train with a larger effective batch size, default to `1` (no accumulation). The
+            losses are divided by `accumulation_steps` for the backward passes, but are stored unscaled in
+            `engine.state.output`. When the epoch length is not a multiple of `accumulation_steps`, the optimizers
+            also step at the last iteration of each epoch. With `DistributedDataParallel` networks, the gradients are
+            only all-reduced in the iterations where the optimizers step.
+        amp_dtype: data type used by autocast when `amp` is `True`, default is `torch.float16`. With `torch.bfloat16`,
+            the losses are not scaled and no `GradScaler` is created.
+
+    Raises:
+        ValueError: when `ddp` is True and `torch.distributed` is not initialized.
+        ValueError: when `accumulation_steps` is not a positive integer.
     """
 
     def __init__(
@@ -113,10 +251,26 @@ class AdversarialTrainer(Trainer):
         event_names: list[str | EventEnum] | None = None,
         event_to_attr: dict | None = None,
         decollate: bool = True,
-        optim_set_to_none: bool = False,
+        optim_set_to_none: bool = True,
         to_kwargs: dict | None = None,
         amp_kwargs: dict | None = None,
+        reuse_fake_logits: bool = True,
+        d_concat_inputs: bool = False,
+        d_forward_fp32: bool = False,
+        compile: bool = False,
+        compile_kwargs: dict | None = None,
+        ddp: bool = False,
+        channels_last: bool = False,
+        cuda_graphs: bool = False,
+        keep_intermediate_outputs: bool = True,
+        overlap_d_reals_forward: bool = False,
+        allow_tf32: bool = False,
+        cudnn_benchmark: bool = False,
+        accumulation_steps: int = 1,
+        amp_dtype: torch.dtype = torch.float16,
     ):
+        if accumulation_steps < 1:
+            raise ValueError(f"`accumulation_steps` must be a positive integer, got {accumulation_steps!r}.")
         super().__init__(
             device=device,
             max_epochs=max_epochs,
@@ -140,6 +294,23 @@ class AdversarialTrainer(Trainer):
 
         self.register_events(*AdversarialIterationEvents)
 
+        if (
+            non_blocking
+            and self.state.device.type == "cuda"
+            and isinstance(train_data_loader, DataLoader)
+            and not train_data_loader.pin_memory
+        ):
+            warnings.warn(
+                "non_blocking=True has no effect on the host to device copies when the batches are not in pinned "
+                "memory, consider creating the DataLoader with pin_memory=True."
+            )
+
+        if allow_tf32:
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+        if cudnn_benchmark:
+            torch.backends.cudnn.benchmark = True
+
         self.state.g_network = g_network
         self.state.g_optimizer = g_optimizer
         self.state.g_loss_function = g_loss_function
@@ -149,13 +320,77 @@ class AdversarialTrainer(Trainer):
         self.state.d_optimizer = d_optimizer
         self.state.d_loss_function = d_loss_function
 
+        if channels_last:
+            g_network.to(memory_format=torch.channels_last)  # type: ignore[call-overload]
+            d_network.to(memory_format=torch.channels_last)  # type: ignore[call-overload]
+        self.channels_last = channels_last
+        self.keep_intermediate_outputs = keep_intermediate_outputs
+
+        # networks used for the forward passes, the ones in the state are kept as given for the checkpoints
+        self._g_network = g_network
+        self._d_network = d_network
+        if ddp:
+            if not torch.distributed.is_available() or not torch.distributed.is_initialized():
+                raise ValueError("ddp=True requires torch.distributed to be initialized.")
+            device_ids = [self.state.device.index] if self.state.device.type == "cuda" else None
+            ddp_kwargs = {
+                "device_ids": device_ids,
+                "broadcast_buffers": False,
+                "gradient_as_bucket_view": True,
+                "find_unused_parameters": False,
+            }
+            if not isinstance(g_network, DistributedDataParallel):
+                self._g_network = DistributedDataParallel(g_network, **ddp_kwargs)
+            if not isinstance(d_network, DistributedDataParallel):
+                self._d_network = DistributedDataParallel(d_network, **ddp_kwargs)
+        self.ddp = ddp
+        if cuda_graphs:
+            compile = True
+            compile_kwargs = {"mode": "reduce-overhead", **({} if compile_kwargs is None else compile_kwargs)}
+        if compile:
+            if pytorch_after(2, 1):
+                compile_kwargs = {} if compile_kwargs is None else compile_kwargs
+                self._g_network = torch.compile(self._g_network, **compile_kwargs)  # type: ignore[assignment]
+                self._d_network = torch.compile(self._d_network, **compile_kwargs)  # type: ignore[assignment]
+            else:
+                warnings.warn(
+                    "Network compilation (compile=True) not supported for Pytorch versions before 2.1, no compilation done"
+                )
+                compile = False
+        self.compile = compile
+        self.cuda_graphs = cuda_graphs and compile
+
         self.g_inferer = SimpleInferer() if g_inferer is None else g_inferer
         self.d_inferer = SimpleInferer() if d_inferer is None else d_inferer
 
-        self.state.g_scaler = torch.cuda.amp.GradScaler() if self.amp else None
-        self.state.d_scaler = torch.cuda.amp.GradScaler() if self.amp else None
+        # a dtype given in amp_kwargs takes precedence over amp_dtype
+        self.amp_kwargs = {"dtype": amp_dtype, **self.amp_kwargs}
+        # bfloat16 has the same range as float32, so the losses do not need to be scaled
+        use_scaler = self.amp and self.amp_kwargs["dtype"] != torch.bfloat16
+        self.state.g_scaler = _grad_scaler() if use_scaler else None
+        self.state.d_scaler = _grad_scaler() if use_scaler else None
 
         self.optim_set_to_none = optim_set_to_none
+        self.reuse_fake_logits = reuse_fake_logits
+        if d_concat_inputs and reuse_fake_logits:
+            warnings.warn(
+                "d_concat_inputs=True is only used when reuse_fake_logits=False, the real and fake images will not be "
+                "concatenated."
+            )
+            d_concat_inputs = False
+        self.d_concat_inputs = d_concat_inputs
+        self.d_forward_fp32 = d_forward_fp32
+        self.accumulation_steps = accumulation_steps
+
+        self._d_stream = None
+        if overlap_d_reals_forward and self.state.device.type == "cuda":
+            if ddp or d_concat_inputs or self.cuda_graphs:
+                warnings.warn(
+                    "overlap_d_reals_forward=True is not supported with ddp, d_concat_inputs or cuda_graphs, "
+                    "the D forward on the reals will not be overlapped."
+                )
+            else:
+                self._d_stream = torch.cuda.Stream(device=self.state.device)
         self._complete_state_dict_user_keys()
 
     def _complete_state_dict_user_keys(self) -> None:
@@ -166,9 +401,11 @@ class AdversarialTrainer(Trainer):
         Follows the example found at:
             https://pytorch.org/ignite/generated/ignite.engine.engine.Engine.html#ignite.engine.engine.Engine.state_dict
         """
-        self._state_dict_user_keys.extend(
-            ["g_network", "g_optimizer", "d_network", "d_optimizer", "g_scaler", "d_scaler"]
-        )
+        self._state_dict_user_keys.extend(["g_network", "g_optimizer", "d_network", "d_optimizer"])
+        if self.state.g_scaler is not None:
+            self._state_dict_user_keys.append("g_scaler")
+        if self.state.d_scaler is not None:
+            self._state_dict_user_keys.append("d_scaler")
 
         g_loss_state_dict = getattr(self.state.g_loss_function, "state_dict", None)
         if callable(g_loss_state_dict):
@@ -182,6 +419,15 @@ class AdversarialTrainer(Trainer):
         if callable(recon_loss_state_dict):
             self._state_dict_user_keys.append("recon_loss_function")
 
+    def _fire_event_if_handled(self, event_name: EventEnum) -> None:
+        """
+        Fire `event_name` only if some handlers are attached to it. Most of the `AdversarialIterationEvents` usually
+        have none, and their dispatch is pure overhead in every iteration. Looking up the handlers at each call keeps
+        it right for the handlers added or removed during the run.
+        """
+        if self._event_handlers.get(event_name):
+            self.fire_event(event_name)
+
     def _iteration(
         self, engine: AdversarialTrainer, batchdata: dict[str, torch.Tensor]
     ) -> dict[str, torch.Tensor | int | float | bool]:
@@ -215,6 +461,9 @@ class AdversarialTrainer(Trainer):
 
         if batchdata is None:
             raise ValueError("Must provide batch data for current iteration.")
+        if engine.cuda_graphs:
+            # the outputs of the previous iteration are not used anymore, so their CUDA graph memory can be reused
+            torch.compiler.cudagraph_mark_step_begin()
         batch = engine.prepare_batch(batchdata, engine.state.device, engine.non_blocking, **engine.to_kwargs)
 
         if len(batch) == 2:
@@ -223,96 +472,221 @@ class AdversarialTrainer(Trainer):
             kwargs: dict = {}
         else:
             inputs, targets, args, kwargs = batch
+        if engine.channels_last:
+            inputs = _contiguous(inputs, True)
+            # the targets are None for the batches without label, e.g. with `default_prepare_batch`
+            if isinstance(targets, torch.Tensor):
+                targets = _contiguous(targets, True)
+        # as in MONAI's `SupervisedTrainer`, compiled networks are given plain tensors, as MetaTensor inputs are not
+        # supported by `torch.compile` (https://github.com/pytorch/pytorch/issues/117026)
+        if engine.compile:
+            inputs_meta, targets_meta, inputs_applied_operations, targets_applied_operations = None, None, None, None
+            if isinstance(inputs, MetaTensor):
+                warnings.warn(
+                    "Will convert to PyTorch Tensor if using compile, and casting back to MetaTensor after the forward pass."
+                )
+                inputs, inputs_meta, inputs_applied_operations = (
+                    inputs.as_tensor(),
+                    inputs.meta,
+                    inputs.applied_operations,
+                )
+            if isinstance(targets, MetaTensor):
+                targets, targets_meta, targets_applied_operations = (
+                    targets.as_tensor(),
+                    targets.meta,
+                    targets.applied_operations,
+                )
+
+        # the outputs are written directly in the engine state only if the handlers need them during the iteration
+        output = {Keys.IMAGE: inputs, Keys.LABEL: targets, AdversarialKeys.REALS: inputs}
+        if engine.keep_intermediate_outputs:
+            engine.state.output = output
+
+        # determine the gradient accumulation state, the optimizers always step at the last iteration of an epoch
+        acc = engine.accumulation_steps
+        if acc > 1:
+            epoch_length = engine.state.epoch_length
+            if epoch_length is not None:
+                local_iter = (engine.state.iteration - 1) % epoch_length  # 0-indexed within epoch
+                should_zero_grad = local_iter % acc == 0
+                should_step = (local_iter + 1) % acc == 0 or (local_iter + 1) == epoch_length
+            else:
+                local_iter = engine.state.iteration - 1  # 0-indexed global
+                should_zero_grad = local_iter % acc == 0
+                should_step = (local_iter + 1) % acc == 0
+        else:
+            should_zero_grad = True
+            should_step = True
 
-        engine.state.output = {Keys.IMAGE: inputs, Keys.LABEL: targets, AdversarialKeys.REALS: inputs}
+        def _accumulation_context(network: torch.nn.Module) -> AbstractContextManager:
+            # the gradients of the iterations without optimizer step are only accumulated locally, not all-reduced
+            return nullcontext() if should_step else _no_sync(network)
 
         def _compute_generator_loss() -> None:
             # TODO: Have a callable functions that process the input to the networks/losses such that peculiar outputs
             #  are handled properly
-            engine.state.output[AdversarialKeys.FAKES] = engine.g_inferer(
-                inputs, engine.state.g_network, *args, **kwargs
+            output[AdversarialKeys.FAKES] = engine.g_inferer(inputs, engine._g_network, *args, **kwargs)
+            output[Keys.PRED] = output[AdversarialKeys.FAKES]
+            engine._fire_event_if_handled(AdversarialIterationEvents.GENERATOR_FORWARD_COMPLETED)
+
+            # under autocast, the ops of D are already cast to the right precision, so the fakes are left as they are
+            fakes = _contiguous(output[AdversarialKeys.FAKES], engine.channels_last)
+            if engine.d_forward_fp32 and not engine.amp:
+                fakes = fakes.float()
+            # the D gradients computed by the generator backward are discarded, so they are not synchronised
+            with _no_sync(engine._d_network):
+                output[AdversarialKeys.FAKE_LOGITS] = engine.d_inferer(fakes, engine._d_network, *args, **kwargs)
+            engine._fire_event_if_handled(AdversarialIterationEvents.GENERATOR_DISCRIMINATOR_FORWARD_COMPLETED)
+
+            output[AdversarialKeys.RECONSTRUCTION_LOSS] = _mean(
+                engine.state.recon_loss_function(output[AdversarialKeys.FAKES], targets)
             )
-            engine.state.output[Keys.PRED] = engine.state.output[AdversarialKeys.FAKES]
-            engine.fire_event(AdversarialIterationEvents.GENERATOR_FORWARD_COMPLETED)
+            engine._fire_event_if_handled(AdversarialIterationEvents.RECONSTRUCTION_LOSS_COMPLETED)
 
-            engine.state.output[AdversarialKeys.FAKE_LOGITS] = engine.d_inferer(
-                engine.state.output[AdversarialKeys.FAKES].float().contiguous(), engine.state.d_network, *args, **kwargs
+            output[AdversarialKeys.GENERATOR_LOSS] = _mean(
+                engine.state.g_loss_function(output[AdversarialKeys.FAKE_LOGITS])
             )
-            engine.fire_event(AdversarialIterationEvents.GENERATOR_DISCRIMINATOR_FORWARD_COMPLETED)
+            engine._fire_event_if_handled(AdversarialIterationEvents.GENERATOR_LOSS_COMPLETED)
 
-            engine.state.output[AdversarialKeys.RECONSTRUCTION_LOSS] = engine.state.recon_loss_function(
-                engine.state.output[AdversarialKeys.FAKES], targets
-            ).mean()
-            engine.fire_event(AdversarialIterationEvents.RECONSTRUCTION_LOSS_COMPLETED)
-
-            engine.state.output[AdversarialKeys.GENERATOR_LOSS] = engine.state.g_loss_function(
-                engine.state.output[AdversarialKeys.FAKE_LOGITS]
-            ).mean()
-            engine.fire_event(AdversarialIterationEvents.GENERATOR_LOSS_COMPLETED)
+            # the losses are read back from the output, as the handlers of the events above may have modified them
+            output[Keys.LOSS] = output[AdversarialKeys.RECONSTRUCTION_LOSS] + output[AdversarialKeys.GENERATOR_LOSS]
 
         # Train Generator
         engine.state.g_network.train()
-        engine.state.g_optimizer.zero_grad(set_to_none=engine.optim_set_to_none)
-
-        if engine.amp and engine.g_scaler is not None:
-            with torch.cuda.amp.autocast(**engine.amp_kwargs):
+        if should_zero_grad:
+            engine.state.g_optimizer.zero_grad(set_to_none=engine.optim_set_to_none)
+
+        # the generator backward only computes the gradients of G, those of D would be discarded or, when accumulating,
+        # added to the ones of the discriminator step
+        g_inputs = _optimizer_params(engine.state.g_optimizer)
+
+        with _accumulation_context(engine._g_network):
+            if engine.amp:
+                with torch.autocast("cuda", **engine.amp_kwargs):
+                    _compute_generator_loss()
+            else:
                 _compute_generator_loss()
 
-            engine.state.output[Keys.LOSS] = (
-                engine.state.output[AdversarialKeys.RECONSTRUCTION_LOSS]
-                + engine.state.output[AdversarialKeys.GENERATOR_LOSS]
-            )
-            engine.state.g_scaler.scale(engine.state.output[Keys.LOSS]).backward()
-            engine.fire_event(AdversarialIterationEvents.GENERATOR_BACKWARD_COMPLETED)
-            engine.state.g_scaler.step(engine.state.g_optimizer)
-            engine.state.g_scaler.update()
-        else:
-            _compute_generator_loss()
-            (
-                engine.state.output[AdversarialKeys.RECONSTRUCTION_LOSS]
-                + engine.state.output[AdversarialKeys.GENERATOR_LOSS]
-            ).backward()
-            engine.fire_event(AdversarialIterationEvents.GENERATOR_BACKWARD_COMPLETED)
-            engine.state.g_optimizer.step()
-        engine.fire_event(AdversarialIterationEvents.GENERATOR_MODEL_COMPLETED)
+            # the real images come from the data loader, already in the memory format used by the networks and usually
+            # not attached to any graph, so they are only detached if needed
+            reals = output[AdversarialKeys.REALS]
+            if reals.requires_grad:
+                reals = reals.detach()
+
+            # the D forward on the reals does not depend on G, so it runs on its own stream during the G backward
+            d_reals_event, overlapped_real_logits = None, None
+            if engine._d_stream is not None:
+                engine.state.d_network.train()
+                engine._d_stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(engine._d_stream), _accumulation_context(engine._d_network):
+                    with torch.autocast("cuda", **engine.amp_kwargs) if engine.amp else nullcontext():
+                        overlapped_real_logits = engine.d_inferer(reals, engine._d_network, *args, **kwargs)
+                    d_reals_event = torch.cuda.Event()
+                    d_reals_event.record(engine._d_stream)
+
+            g_loss = output[Keys.LOSS] / acc if acc > 1 else output[Keys.LOSS]
+            if engine.state.g_scaler is not None:
+                engine.state.g_scaler.scale(g_loss).backward(inputs=g_inputs, retain_graph=engine.reuse_fake_logits)
+                engine._fire_event_if_handled(AdversarialIterationEvents.GENERATOR_BACKWARD_COMPLETED)
+                if should_step:
+                    engine.state.g_scaler.step(engine.state.g_optimizer)
+                    engine.state.g_scaler.update()
+            else:
+                g_loss.backward(inputs=g_inputs, retain_graph=engine.reuse_fake_logits)
+                engine._fire_event_if_handled(AdversarialIterationEvents.GENERATOR_BACKWARD_COMPLETED)
+                if should_step:
+                    engine.state.g_optimizer.step()
+        engine._fire_event_if_handled(AdversarialIterationEvents.GENERATOR_MODEL_COMPLETED)
+
+        if not engine.keep_intermediate_outputs:
+            # release the graph of the generator before the discriminator step, unless the fake logits still need it
+            for key in (Keys.LOSS, AdversarialKeys.RECONSTRUCTION_LOSS, AdversarialKeys.GENERATOR_LOSS):
+                output[key] = output[key].detach()
+            if not engine.reuse_fake_logits:
+                output[Keys.PRED] = output[AdversarialKeys.FAKES] = output[AdversarialKeys.FAKES].detach()
+                output[AdversarialKeys.FAKE_LOGITS] = _detach(output[AdversarialKeys.FAKE_LOGITS])
 
         def _compute_discriminator_loss() -> None:
-            engine.state.output[AdversarialKeys.REAL_LOGITS] = engine.d_inferer(
-                engine.state.output[AdversarialKeys.REALS].contiguous().detach(),
-                engine.state.d_network,
-                *args,
-                **kwargs,
+            if engine.d_concat_inputs and not engine.reuse_fake_logits:
+                fakes = _contiguous(output[AdversarialKeys.FAKES].detach(), engine.channels_last)
+                logits = engine.d_inferer(torch.cat([reals, fakes], dim=0), engine._d_network, *args, **kwargs)
+                real_logits, fake_logits = _split_batch(logits, reals.shape[0])
+
+                output[AdversarialKeys.REAL_LOGITS] = real_logits
+                engine._fire_event_if_handled(AdversarialIterationEvents.DISCRIMINATOR_REALS_FORWARD_COMPLETED)
+                output[AdversarialKeys.FAKE_LOGITS] = fake_logits
+                engine._fire_event_if_handled(AdversarialIterationEvents.DISCRIMINATOR_FAKES_FORWARD_COMPLETED)
+            else:
+                if d_reals_event is not None:
+                    torch.cuda.current_stream().wait_event(d_reals_event)
+                    output[AdversarialKeys.REAL_LOGITS] = overlapped_real_logits
+                else:
+                    output[AdversarialKeys.REAL_LOGITS] = engine.d_inferer(reals, engine._d_network, *args, **kwargs)
+                engine._fire_event_if_handled(AdversarialIterationEvents.DISCRIMINATOR_REALS_FORWARD_COMPLETED)
+
+                if not engine.reuse_fake_logits:
+                    output[AdversarialKeys.FAKE_LOGITS] = engine.d_inferer(
+                        _contiguous(output[AdversarialKeys.FAKES].detach(), engine.channels_last),
+                        engine._d_network,
+                        *args,
+                        **kwargs,
+                    )
+                engine._fire_event_if_handled(AdversarialIterationEvents.DISCRIMINATOR_FAKES_FORWARD_COMPLETED)
+
+            output[AdversarialKeys.DISCRIMINATOR_LOSS] = _mean(
+                engine.state.d_loss_function(output[AdversarialKeys.REAL_LOGITS], output[AdversarialKeys.FAKE_LOGITS])
             )
-            engine.fire_event(AdversarialIterationEvents.DISCRIMINATOR_REALS_FORWARD_COMPLETED)
-
-            engine.state.output[AdversarialKeys.FAKE_LOGITS] = engine.d_inferer(
-                engine.state.output[AdversarialKeys.FAKES].contiguous().detach(),
-                engine.state.d_network,
-                *args,
-                **kwargs,
-            )
-            engine.fire_event(AdversarialIterationEvents.DISCRIMINATOR_FAKES_FORWARD_COMPLETED)
-
-            engine.state.output[AdversarialKeys.DISCRIMINATOR_LOSS] = engine.state.d_loss_function(
-                engine.state.output[AdversarialKeys.REAL_LOGITS], engine.state.output[AdversarialKeys.FAKE_LOGITS]
-            ).mean()
-            engine.fire_event(AdversarialIterationEvents.DISCRIMINATOR_LOSS_COMPLETED)
+            engine._fire_event_if_handled(AdversarialIterationEvents.DISCRIMINATOR_LOSS_COMPLETED)
 
         # Train Discriminator
         engine.state.d_network.train()
-        engine.state.d_network.zero_grad(set_to_none=engine.optim_set_to_none)
-
-        if engine.amp and engine.d_scaler is not None:
-            with torch.cuda.amp.autocast(**engine.amp_kwargs):
+        if should_zero_grad:
+            engine.state.d_optimizer.zero_grad(set_to_none=engine.optim_set_to_none)
+
+        # the reused fake logits are still attached to the generator graph, so the gradients must only be accumulated
+        # into the parameters of the discriminator
+        d_inputs = _optimizer_params(engine.state.d_optimizer) if engine.reuse_fake_logits else None
+
+        with _accumulation_context(engine._d_network):
+            if engine.amp:
+                with torch.autocast("cuda", **engine.amp_kwargs):
+                    _compute_discriminator_loss()
+            else:
                 _compute_discriminator_loss()
 
-            engine.state.d_scaler.scale(engine.state.output[AdversarialKeys.DISCRIMINATOR_LOSS]).backward()
-            engine.fire_event(AdversarialIterationEvents.DISCRIMINATOR_BACKWARD_COMPLETED)
-            engine.state.d_scaler.step(engine.state.d_optimizer)
-            engine.state.d_scaler.update()
-        else:
-            _compute_discriminator_loss()
-            engine.state.output[AdversarialKeys.DISCRIMINATOR_LOSS].backward()
-            engine.state.d_optimizer.step()
+            d_loss = output[AdversarialKeys.DISCRIMINATOR_LOSS]
+            d_loss = d_loss / acc if acc > 1 else d_loss
+            if engine.state.d_scaler is not None:
+                engine.state.d_scaler.scale(d_loss).backward(inputs=d_inputs)
+                engine._fire_event_if_handled(AdversarialIterationEvents.DISCRIMINATOR_BACKWARD_COMPLETED)
+                if should_step:
+                    engine.state.d_scaler.step(engine.state.d_optimizer)
+                    engine.state.d_scaler.update()
+            else:
+                d_loss.backward(inputs=d_inputs)
+                engine._fire_event_if_handled(AdversarialIterationEvents.DISCRIMINATOR_BACKWARD_COMPLETED)
+                if should_step:
+                    engine.state.d_optimizer.step()
+        engine._fire_event_if_handled(AdversarialIterationEvents.DISCRIMINATOR_MODEL_COMPLETED)
+
+        # copy back meta info
+        if engine.compile:
+            if inputs_meta is not None:
+                output[Keys.IMAGE] = output[AdversarialKeys.REALS] = MetaTensor(
+                    inputs, meta=inputs_meta, applied_operations=inputs_applied_operations
+                )
+                output[Keys.PRED] = output[AdversarialKeys.FAKES] = MetaTensor(
+                    output[Keys.PRED], meta=inputs_meta, applied_operations=inputs_applied_operations
+                )
+            if targets_meta is not None:
+                output[Keys.LABEL] = MetaTensor(
+                    targets, meta=targets_meta, applied_operations=targets_applied_operations
+                )
+
+        if engine.reuse_fake_logits or not engine.keep_intermediate_outputs:
+            # without references to the graphs left, their memory is released as soon as the iteration completes. the
+            # graph of G retained for the reused fake logits is not traversed by the D backward, so it would otherwise
+            # stay alive until the outputs of the next iteration replace these ones
+            engine.state.output = {key: _detach(value) for key, value in output.items()}
 
         return engine.state.output
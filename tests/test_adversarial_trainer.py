@@ -0,0 +1,252 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import gc
+import unittest
+import weakref
+from unittest import mock
+
+import torch
+import torch.distributed as dist
+from monai.data import MetaTensor
+from monai.utils import CommonKeys
+from parameterized import parameterized
+
+from generative.engines import AdversarialTrainer
+from generative.utils import AdversarialIterationEvents, AdversarialKeys
+from tests.utils import DistCall, DistTestCase, SkipIfBeforePyTorchVersion, skip_if_no_cuda
+
+TEST_CASES_RUN = [
+    [{"reuse_fake_logits": True}],
+    [{"reuse_fake_logits": False}],
+    [{"reuse_fake_logits": False, "d_concat_inputs": True}],
+    [{"amp": True}],
+    [{"amp": True, "amp_dtype": torch.bfloat16}],
+]
+
+# options that must not change the result of the training with respect to the reference, `reuse_fake_logits=False`
+TEST_CASES_EQUIVALENT = [
+    [{"reuse_fake_logits": True}],
+    [{"reuse_fake_logits": False, "d_concat_inputs": True}],
+    [{"channels_last": True}],
+    [{"keep_intermediate_outputs": False}],
+    [{"keep_intermediate_outputs": False, "reuse_fake_logits": False}],
+]
+
+
+def get_trainer(data_seed=0, merge_batches=False, device="cpu", **kwargs):
+    torch.manual_seed(0)
+    g_network = torch.nn.Sequential(
+        torch.nn.Conv2d(1, 4, 3, padding=1), torch.nn.ReLU(), torch.nn.Conv2d(4, 1, 3, padding=1)
+    )
+    d_network = torch.nn.Sequential(
+        torch.nn.Conv2d(1, 4, 3, stride=2), torch.nn.ReLU(), torch.nn.Flatten(), torch.nn.Linear(4 * 7 * 7, 1)
+    )
+    g_network.to(device)
+    d_network.to(device)
+    torch.manual_seed(data_seed)
+    data = [{CommonKeys.IMAGE: torch.rand(2, 1, 16, 16), CommonKeys.LABEL: torch.rand(2, 1, 16, 16)} for _ in range(2)]
+    if merge_batches:
+        data = [{key: torch.cat([d[key] for d in data]) for key in data[0]}]
+    bce = torch.nn.BCEWithLogitsLoss()
+
+    def discriminator_loss(real_logits, fake_logits):
+        return (bce(real_logits, torch.ones_like(real_logits)) + bce(fake_logits, torch.zeros_like(fake_logits))) / 2
+
+    trainer = AdversarialTrainer(
+        device=device,
+        max_epochs=2,
+        epoch_length=len(data),
+        train_data_loader=data,
+        g_network=g_network,
+        g_optimizer=torch.optim.Adam(g_network.parameters(), 1e-3),
+        g_loss_function=lambda fake_logits: bce(fake_logits, torch.ones_like(fake_logits)),
+        recon_loss_function=torch.nn.MSELoss(),
+        d_network=d_network,
+        d_optimizer=torch.optim.Adam(d_network.parameters(), 1e-3),
+        d_loss_function=discriminator_loss,
+        **kwargs,
+    )
+    return trainer
+
+
+class TestAdversarialTrainer(unittest.TestCase):
+    @parameterized.expand(TEST_CASES_RUN)
+    def test_run(self, input_param):
+        trainer = get_trainer(**input_param)
+        trainer.run()
+        self.assertEqual(trainer.state.iteration, 4)
+        for key in (
+            AdversarialKeys.RECONSTRUCTION_LOSS,
+            AdversarialKeys.GENERATOR_LOSS,
+            AdversarialKeys.DISCRIMINATOR_LOSS,
+        ):
+            self.assertTrue(torch.isfinite(trainer.state.output[key]))
+
+    def test_events(self):
+        trainer = get_trainer()
+        fired = []
+        trainer.add_event_handler(AdversarialIterationEvents.GENERATOR_FORWARD_COMPLETED, lambda e: fired.append(1))
+        trainer.add_event_handler(AdversarialIterationEvents.DISCRIMINATOR_LOSS_COMPLETED, lambda e: fired.append(2))
+        trainer.add_event_handler(AdversarialIterationEvents.DISCRIMINATOR_MODEL_COMPLETED, lambda e: fired.append(3))
+        trainer.run()
+        self.assertEqual(fired, [1, 2, 3] * 4)
+
+    def test_bfloat16_no_scaler(self):
+        trainer = get_trainer(amp=True, amp_dtype=torch.bfloat16)
+        self.assertIsNone(trainer.state.g_scaler)
+        self.assertIsNone(trainer.state.d_scaler)
+        self.assertNotIn("g_scaler", trainer.state_dict())
+        self.assertNotIn("d_scaler", trainer.state_dict())
+
+    @parameterized.expand([[{"keep_intermediate_outputs": False}], [{}]])
+    def test_no_intermediate_outputs(self, input_param):
+        trainer = get_trainer(**input_param)
+        trainer.run()
+        for value in trainer.state.output.values():
+            self.assertIsNone(value.grad_fn)
+
+    def test_generator_graph_released(self):
+        # the activations of G are saved by its graph, which must be released after each iteration
+        trainer = get_trainer()
+        activations = []
+        trainer.state.g_network[1].register_forward_hook(lambda m, i, o: activations.append(weakref.ref(o)))
+        trainer.run()
+        gc.collect()
+        self.assertEqual([a() for a in activations], [None] * 4)
+
+    @SkipIfBeforePyTorchVersion((2, 1))
+    def test_compile_state(self):
+        trainer = get_trainer(compile=True)
+        self.assertIsInstance(trainer._g_network, torch._dynamo.eval_frame.OptimizedModule)
+        self.assertIsInstance(trainer._d_network, torch._dynamo.eval_frame.OptimizedModule)
+        self.assertNotIsInstance(trainer.state.g_network, torch._dynamo.eval_frame.OptimizedModule)
+        self.assertNotIsInstance(trainer.state.d_network, torch._dynamo.eval_frame.OptimizedModule)
+        for key in trainer.state_dict()["g_network"].state_dict():
+            self.assertFalse(key.startswith("_orig_mod"))
+        trainer.run()
+        trainer_ref = get_trainer()
+        trainer_ref.run()
+        self._assert_same_networks(trainer, trainer_ref)
+
+    @SkipIfBeforePyTorchVersion((2, 1))
+    def test_compile_meta_tensor(self):
+        trainer = get_trainer(compile=True)
+        trainer.data_loader = [
+            {key: MetaTensor(value, meta={"name": key}) for key, value in batch.items()}
+            for batch in trainer.data_loader
+        ]
+        trainer.run()
+        for key, meta_key in (
+            (CommonKeys.IMAGE, CommonKeys.IMAGE),
+            (CommonKeys.PRED, CommonKeys.IMAGE),
+            (CommonKeys.LABEL, CommonKeys.LABEL),
+        ):
+            self.assertIsInstance(trainer.state.output[key], MetaTensor)
+            self.assertEqual(trainer.state.output[key].meta["name"], meta_key)
+
+    @SkipIfBeforePyTorchVersion((2, 1))
+    def test_cuda_graphs_compile(self):
+        trainer = get_trainer(cuda_graphs=True)
+        self.assertTrue(trainer.compile)
+        self.assertTrue(trainer.cuda_graphs)
+        trainer.run()
+        trainer_ref = get_trainer()
+        trainer_ref.run()
+        self._assert_same_networks(trainer, trainer_ref)
+
+    @skip_if_no_cuda
+    @SkipIfBeforePyTorchVersion((2, 1))
+    def test_cuda_graphs_gpu(self):
+        # the reused fake logits are backpropagated through the D graphs captured during the generator step
+        trainer = get_trainer(device="cuda", cuda_graphs=True)
+        trainer.run()
+        trainer_ref = get_trainer(device="cuda")
+        trainer_ref.run()
+        self._assert_same_networks(trainer, trainer_ref)
+
+    @parameterized.expand(TEST_CASES_EQUIVALENT)
+    def test_equivalent(self, input_param):
+        trainer = get_trainer(**input_param)
+        trainer.run()
+        trainer_ref = get_trainer(reuse_fake_logits=False)
+        trainer_ref.run()
+        self._assert_same_networks(trainer, trainer_ref)
+
+    @parameterized.expand([[True], [False]])
+    def test_accumulation(self, reuse_fake_logits):
+        # accumulating the gradients of 2 batches is the same as training on a single batch made of both of them
+        trainer = get_trainer(accumulation_steps=2, reuse_fake_logits=reuse_fake_logits)
+        trainer.run()
+        trainer_ref = get_trainer(merge_batches=True, reuse_fake_logits=reuse_fake_logits)
+        trainer_ref.run()
+        self._assert_same_networks(trainer, trainer_ref)
+
+    def test_overlap_d_reals_forward(self):
+        # the CUDA stream and event are mocked, so that the overlapped D forward on the reals runs on CPU
+        trainer = get_trainer()
+        trainer._d_stream = mock.MagicMock()
+        with mock.patch("torch.cuda.stream"), mock.patch("torch.cuda.Event"), mock.patch("torch.cuda.current_stream"):
+            trainer.run()
+        trainer._d_stream.wait_stream.assert_called()
+        trainer_ref = get_trainer(reuse_fake_logits=False)
+        trainer_ref.run()
+        self._assert_same_networks(trainer, trainer_ref)
+
+    def test_channels_last_no_label(self):
+        trainer = get_trainer(channels_last=True)
+        trainer.state.recon_loss_function = lambda fakes, targets: fakes.abs().mean()
+        trainer.data_loader = [{CommonKeys.IMAGE: torch.rand(2, 1, 16, 16)} for _ in range(2)]
+        trainer.run()
+        self.assertIsNone(trainer.state.output[CommonKeys.LABEL])
+
+    def test_concat_inputs_with_reuse_warns(self):
+        with self.assertWarns(UserWarning):
+            trainer = get_trainer(d_concat_inputs=True)
+        self.assertFalse(trainer.d_concat_inputs)
+
+    def test_accumulation_steps_invalid(self):
+        with self.assertRaises(ValueError):
+            get_trainer(accumulation_steps=0)
+
+    def _assert_same_networks(self, trainer, trainer_ref):
+        for network in ("g_network", "d_network"):
+            for p, p_ref in zip(
+                getattr(trainer.state, network).parameters(), getattr(trainer_ref.state, network).parameters()
+            ):
+                torch.testing.assert_close(p, p_ref)
+
+
+class TestAdversarialTrainerDDP(DistTestCase):
+    @DistCall(nnodes=1, nproc_per_node=2, backend="gloo")
+    def test_ddp(self):
+        # different data on each process, the networks must still be the same on all of them after training
+        trainer = get_trainer(data_seed=dist.get_rank(), ddp=True)
+        self._check_networks_synced(trainer)
+
+    @DistCall(nnodes=1, nproc_per_node=2, backend="gloo")
+    def test_ddp_accumulation(self):
+        trainer = get_trainer(data_seed=dist.get_rank(), ddp=True, accumulation_steps=2)
+        self._check_networks_synced(trainer)
+
+    def _check_networks_synced(self, trainer):
+        trainer.run()
+        for network in ("g_network", "d_network"):
+            for p in getattr(trainer.state, network).parameters():
+                p_all = [torch.zeros_like(p) for _ in range(dist.get_world_size())]
+                dist.all_gather(p_all, p.detach())
+                torch.testing.assert_close(p_all[0], p_all[1])
+
+
+if __name__ == "__main__":
+    unittest.main()